@@ -1,12 +1,241 @@
 import argparse
 import csv
+import hashlib
+import multiprocessing as mp
 import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+import numpy as np
 import parselmouth
 import textgrids
 
 FILES_TO_EXCLUDE = []
 
 
+MAX_FORMANT_NUMBER = 4
+
+# Bumped whenever the Burg analysis or the cached arrays change, so old cache entries aren't reused
+FORMANT_CACHE_VERSION = "1"
+# Cache entries beyond this many are removed after each run, oldest first,
+# though entries used by the current run are always kept
+MAX_FORMANT_CACHE_ENTRIES = 1000
+
+
+def load_formant_track(audio_file_path, maximum_formant, cache_dir=None):
+    """
+    Runs the Burg formant analysis on an audio file and reads the result into
+    arrays. When cache_dir is given, the arrays are saved there keyed by the
+    file's path, modification time and maximum_formant, so later runs on the
+    same audio skip the analysis. Unreadable entries are recomputed, and a
+    failed write only prints a warning.
+
+    Args:
+        audio_file_path (str): Path to the audio file
+        maximum_formant (int): Ceiling of the formant search range in Hz, passed to to_formant_burg
+        cache_dir (str): Folder for cached formant tracks, or None to disable caching
+
+    Returns:
+        tuple: (values, sampling), where values has shape (MAX_FORMANT_NUMBER, number of frames) with NaN
+               where a formant is undefined, and sampling is [xmin, xmax, x1, dx] of the formant object
+    """
+    if cache_dir is not None:
+        key_source = "|".join(
+            [
+                FORMANT_CACHE_VERSION,
+                os.path.abspath(audio_file_path),
+                str(os.path.getmtime(audio_file_path)),
+                str(maximum_formant),
+            ]
+        )
+        key = hashlib.sha1(key_source.encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, f"{key}.npz")
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    values, sampling = cached["values"], cached["sampling"]
+            except (OSError, ValueError, KeyError) as e:
+                print(
+                    f"Ignoring unreadable formant cache entry {cache_file}: {e}"
+                )
+            else:
+                # Marks the entry as recently used so pruning keeps it
+                try:
+                    os.utime(cache_file)
+                except OSError:
+                    pass
+                return values, sampling
+
+    sound = parselmouth.Sound(audio_file_path)
+    formants = sound.to_formant_burg(maximum_formant=maximum_formant)
+
+    # Frames without a given formant are stored as 0 in the matrix
+    values = np.array(
+        [
+            parselmouth.praat.call(
+                formants, "To Matrix", formant_number
+            ).values[0]
+            for formant_number in range(1, MAX_FORMANT_NUMBER + 1)
+        ]
+    )
+    values[values == 0] = np.nan
+    sampling = np.array(
+        [formants.xmin, formants.xmax, formants.x1, formants.dx]
+    )
+
+    if cache_dir is not None:
+        # Writes to a temporary file first so an interrupted run leaves no partial cache entry
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(temp_file, "wb") as f:
+                np.savez_compressed(f, values=values, sampling=sampling)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print(f"Not caching formants for {audio_file_path}: {e}")
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+    return values, sampling
+
+
+def formant_values_at_times(values, sampling, desired_formants, times):
+    """
+    Looks up formant values for many time points at once. Mirrors Praat's
+    "Get value at time" with linear interpolation, but works on the arrays
+    from load_formant_track instead of calling into Praat for every time point.
+
+    Args:
+        values (numpy.ndarray): Formant values per frame, as returned by load_formant_track
+        sampling (numpy.ndarray): [xmin, xmax, x1, dx], as returned by load_formant_track
+        desired_formants (list): A list of integers specifying the formants to look up
+        times (numpy.ndarray): Time points (in seconds) to look up
+
+    Returns:
+        numpy.ndarray: Array of shape (len(desired_formants), len(times)), NaN where undefined
+    """
+    xmin, xmax, x1, dx = sampling
+    nx = values.shape[1]
+    values = values[
+        [int(formant_number) - 1 for formant_number in desired_formants]
+    ]
+
+    # Finds the nearest frame and the frame on the other side of each time point.
+    # Formant frames are evenly spaced, so frame indices follow from x1 and dx
+    # directly and no search over the frame times is needed.
+    frame_index = (times - x1) / dx
+    left = np.floor(frame_index).astype(int)
+    phase = frame_index - left
+    near_is_left = phase < 0.5
+    near = np.where(near_is_left, left, left + 1)
+    far = np.where(near_is_left, left + 1, left)
+    phase = np.where(near_is_left, phase, 1.0 - phase)
+
+    near_valid = (near >= 0) & (near < nx) & (times >= xmin) & (times <= xmax)
+    far_valid = (far >= 0) & (far < nx)
+    near_values = values[:, np.clip(near, 0, nx - 1)]
+    far_values = values[:, np.clip(far, 0, nx - 1)]
+
+    # Falls back to the nearest frame at the edges or next to undefined frames
+    result = np.where(
+        far_valid & ~np.isnan(far_values),
+        near_values + phase * (far_values - near_values),
+        near_values,
+    )
+    result[:, ~near_valid] = np.nan
+    return result
+
+
+def get_fieldnames(desired_formants, include_following=False):
+    """
+    Args:
+        desired_formants (list): A list of integers specifying the formants to extract (e.g., [1, 2])
+        include_following (bool): Whether formant values for the following phone are included
+
+    Returns:
+        list: The CSV column names, in the order of the rows returned by extract_formants_from_file
+    """
+    fieldnames = [
+        "file",
+        "speaker",
+        "phone",
+        "preceding_phone",
+        "following_phone",
+        "point",
+        "interval_start",
+        "interval_end",
+    ] + [f"F{formant_number}" for formant_number in desired_formants]
+    if include_following:
+        fieldnames += [
+            f"following_F{formant_number}"
+            for formant_number in desired_formants
+        ]
+    return fieldnames
+
+
+def find_matching_intervals(grid, filename, phones):
+    """
+    Scans the phone tiers of a TextGrid once and collects the intervals to
+    measure, without looking up any formant values. Tiers are scanned one
+    after another: the scan is pure Python, so threads would only contend for
+    the GIL, and files are already spread over worker processes.
+
+    Args:
+        grid (textgrids.TextGrid): The parsed TextGrid
+        filename (str): Name of the TextGrid file, used to pick the speaker tiers
+        phones (list): A list of phone labels to extract formants for
+
+    Returns:
+        list: (speaker, interval, preceding_phone, following_phone, following_interval) tuples,
+              where following_interval is None when there is no following phone
+    """
+    phones_set = frozenset(phones)
+    all_vowels = "ALL_VOWELS" in phones_set
+    matches = []
+
+    for tier_name, tier in grid.items():
+        if "phones" in tier_name:
+            # Extracts the part before the first space
+            speaker_from_tier = tier_name.split()[0]
+
+            # Checks if this speaker name is in the filename
+            if speaker_from_tier in filename:
+                speaker_name = speaker_from_tier
+                print(f"Processing speaker: {speaker_name}")
+                n = len(tier)
+
+                for i, interval in enumerate(tier):
+                    if interval.text in phones_set or (
+                        all_vowels
+                        and interval.text != "sil"
+                        and interval.containsvowel()
+                    ):
+                        # Gets preceding and following phones, indexing the tier once per neighbour
+                        preceding_phone = tier[i - 1].text if i > 0 else None
+                        next_interval = tier[i + 1] if i < n - 1 else None
+                        following_phone = (
+                            next_interval.text
+                            if next_interval is not None
+                            else None
+                        )
+                        following_interval = (
+                            next_interval if following_phone else None
+                        )
+
+                        matches.append(
+                            (
+                                speaker_name,
+                                interval,
+                                preceding_phone,
+                                following_phone,
+                                following_interval,
+                            )
+                        )
+
+    return matches
+
+
 def extract_formants_from_file(
     audio_file_path,
     textgrid_file_path,
@@ -14,6 +243,8 @@ def extract_formants_from_file(
     desired_formants,
     points,
     include_following=False,
+    maximum_formant=3000,
+    cache_dir=None,
 ):
     """
     Args:
@@ -24,101 +255,192 @@ def extract_formants_from_file(
         points (list): A list of floats representing the time points (as proportions of the interval duration)
                        at which to extract formant values (e.g., [0.2, 0.5, 0.8])
         include_following (bool): Whether to include formant values for the following phone
+        maximum_formant (int): Ceiling of the formant search range in Hz, passed to to_formant_burg
+        cache_dir (str): Folder for cached formant tracks, or None to disable caching
 
     Returns:
-        list: A list of dictionaries with "speaker", "phone", "point", "interval_start", "interval_end", "formant", and "formant_value" as columns
+        list: A list of tuples ordered like get_fieldnames(desired_formants, include_following)
     """
-    sound = parselmouth.Sound(audio_file_path)
     grid = textgrids.TextGrid(textgrid_file_path)
-    formants = sound.to_formant_burg(maximum_formant=3000)
     filename = os.path.basename(textgrid_file_path)
+    file_stem = os.path.splitext(os.path.basename(audio_file_path))[0]
 
     formant_list = []
+    matches = find_matching_intervals(grid, filename, phones)
+    if not matches:
+        return formant_list
+
+    # Calculates every time point at once, one row per interval
+    point_array = np.array(points)
+    starts = np.array([interval.xmin for _, interval, _, _, _ in matches])
+    ends = np.array([interval.xmax for _, interval, _, _, _ in matches])
+    time_points = starts[:, None] + (ends - starts)[:, None] * point_array
+    query_times = time_points.ravel()
+    if include_following:
+        # Intervals without a following phone get placeholder times whose values are discarded
+        following_start_array = np.array(
+            [
+                following_interval.xmin if following_interval else 0.0
+                for _, _, _, _, following_interval in matches
+            ]
+        )
+        following_end_array = np.array(
+            [
+                following_interval.xmax if following_interval else 0.0
+                for _, _, _, _, following_interval in matches
+            ]
+        )
+        following_time_points = (
+            following_start_array[:, None]
+            + (following_end_array - following_start_array)[:, None]
+            * point_array
+        )
+        query_times = np.concatenate(
+            [query_times, following_time_points.ravel()]
+        )
 
-    for tier_name, tier in grid.items():
-        if "phones" in tier_name:
-            # Extracts the part before the first space
-            speaker_from_tier = tier_name.split()[0]
+    # Looks up every time point in a single pass, as (interval, point, formant)
+    shape = (len(matches), len(points), len(desired_formants))
+    values, sampling = load_formant_track(
+        audio_file_path, maximum_formant, cache_dir
+    )
+    all_values = formant_values_at_times(
+        values, sampling, desired_formants, query_times
+    ).T
+    formant_values = all_values[: time_points.size].reshape(shape).tolist()
+    if include_following:
+        following_values = (
+            all_values[time_points.size :].reshape(shape).tolist()
+        )
 
-            # Checks if this speaker name is in the filename
-            if speaker_from_tier in filename:
-                speaker_name = speaker_from_tier
-                print(f"Processing speaker: {speaker_name}")
+    # Assembles each output row as one flat tuple, without intermediate tuples
+    missing_following = ("",) * len(desired_formants)
+    following = ()
+    for j, (
+        speaker_name,
+        interval,
+        preceding_phone,
+        following_phone,
+        following_interval,
+    ) in enumerate(matches):
+        for k, point in enumerate(points):
+            if include_following:
+                following = (
+                    following_values[j][k]
+                    if following_interval is not None
+                    else missing_following
+                )
+            formant_list.append(
+                (
+                    file_stem,
+                    speaker_name,
+                    interval.text,
+                    preceding_phone,
+                    following_phone,
+                    point,
+                    interval.xmin,
+                    interval.xmax,
+                    *formant_values[j][k],
+                    *following,
+                )
+            )
 
-                for i, interval in enumerate(tier):
-                    if interval.text in phones or (
-                        "ALL_VOWELS" in phones
-                        and interval.containsvowel()
-                        and interval.text != "sil"
-                    ):
-                        current_phone = (
-                            interval.text
-                        )  # Stores the current phone being processed
+    return formant_list
 
-                        # Gets preceding and following phones
-                        preceding_phone = tier[i - 1].text if i > 0 else None
-                        following_phone = (
-                            tier[i + 1].text if i < len(tier) - 1 else None
-                        )
 
-                        for point in points:
-                            formant_dict = {
-                                "file": os.path.splitext(
-                                    os.path.basename(audio_file_path)
-                                )[0],
-                                "speaker": speaker_name,
-                                "phone": current_phone,
-                                "preceding_phone": preceding_phone,
-                                "following_phone": following_phone,
-                                "point": point,
-                                "interval_start": interval.xmin,
-                                "interval_end": interval.xmax,
-                            }
-
-                            # Calculates time point within the interval
-                            time_point = (
-                                interval.xmin
-                                + (interval.xmax - interval.xmin) * point
-                            )
+def _process_one(task):
+    """
+    Worker that extracts formants for a single matched file.
 
-                            # Extracts formants for current phone
-                            for formant_number in desired_formants:
-                                formant_value = formants.get_value_at_time(
-                                    int(formant_number), time_point
-                                )
-                                formant_dict[f"F{formant_number}"] = (
-                                    formant_value
-                                )
-
-                            # Extracts formants for following phone if it exists
-                            if (
-                                include_following
-                                and following_phone
-                                and i + 1 < len(tier)
-                            ):
-                                following_interval = tier[i + 1]
-                                following_time_point = (
-                                    following_interval.xmin
-                                    + (
-                                        following_interval.xmax
-                                        - following_interval.xmin
-                                    )
-                                    * point
-                                )
-
-                                for formant_number in desired_formants:
-                                    following_formant_value = (
-                                        formants.get_value_at_time(
-                                            int(formant_number),
-                                            following_time_point,
-                                        )
-                                    )
-                                    formant_dict[
-                                        f"following_F{formant_number}"
-                                    ] = following_formant_value
-
-                            formant_list.append(formant_dict)
-    return formant_list
+    Args:
+        task (tuple): (audio_file_path, textgrid_file_path, phones, desired_formants, points, include_following, maximum_formant, cache_dir)
+
+    Returns:
+        list: The rows returned by extract_formants_from_file
+    """
+    (
+        audio_file_path,
+        textgrid_file_path,
+        phones,
+        desired_formants,
+        points,
+        include_following,
+        maximum_formant,
+        cache_dir,
+    ) = task
+    print(
+        f"Processing {os.path.splitext(os.path.basename(audio_file_path))[0]}"
+    )
+    return extract_formants_from_file(
+        audio_file_path=audio_file_path,
+        textgrid_file_path=textgrid_file_path,
+        phones=phones,
+        desired_formants=desired_formants,
+        points=points,
+        include_following=include_following,
+        maximum_formant=maximum_formant,
+        cache_dir=cache_dir,
+    )
+
+
+def process_files(tasks):
+    """
+    Runs _process_one over all tasks in worker processes, yielding each file's
+    rows in the order of tasks so the output is the same from run to run.
+    Workers are spawned rather than forked, since forking a process that holds
+    Praat state is not safe.
+
+    Args:
+        tasks (list): Argument tuples for _process_one, one per file
+
+    Yields:
+        list: The rows for one file
+    """
+    # Each spawned worker re-imports parselmouth, so never start more than there are files
+    max_workers = max(1, min(os.cpu_count() or 1, len(tasks)))
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=mp.get_context("spawn")
+    ) as executor:
+        # map drops each future as it is yielded, so rows are freed once the caller has written them
+        yield from executor.map(_process_one, tasks)
+
+
+def prune_formant_cache(cache_dir, keep):
+    """
+    Removes the least recently used formant cache entries so at most keep remain.
+
+    Args:
+        cache_dir (str): Folder for cached formant tracks
+        keep (int): Number of entries to keep
+    """
+    try:
+        with os.scandir(cache_dir) as entries:
+            cached = sorted(
+                (entry for entry in entries if entry.name.endswith(".npz")),
+                key=lambda entry: entry.stat().st_mtime,
+                reverse=True,
+            )
+        for entry in cached[keep:]:
+            os.remove(entry.path)
+    except OSError as e:
+        print(f"Could not prune formant cache in {cache_dir}: {e}")
+
+
+def index_files(path, suffix):
+    """
+    Args:
+        path (str): Path to a directory
+        suffix (str): File extension to keep (e.g., ".wav")
+
+    Returns:
+        dict: Maps each matching file name without its extension to its full path
+    """
+    with os.scandir(path) as entries:
+        return {
+            entry.name[: -len(suffix)]: entry.path
+            for entry in entries
+            if entry.name.endswith(suffix)
+        }
 
 
 def main():
@@ -170,6 +492,17 @@ def main():
         action="store_true",
         help="Include formant measurements for the following phone",
     )
+    parser.add_argument(
+        "--maximum_formant",
+        type=int,
+        default=3000,
+        help="Maximum formant frequency in Hz for the Burg analysis (e.g., 5000)",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Run the formant analysis on every file without reading or writing the formant cache",
+    )
     parser.add_argument(
         "--separate_files",
         action="store_true",
@@ -179,25 +512,25 @@ def main():
     args = parser.parse_args()
 
     os.makedirs(args.output_folder, exist_ok=True)
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = os.path.join(args.output_folder, ".formant_cache")
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Not caching formants in {cache_dir}: {e}")
+            cache_dir = None
 
     if len(args.points) > 3:
         parser.error("You can specify up to 3 measurement points only.")
 
-    audio_files = {
-        os.path.splitext(f)[0]: os.path.join(args.audio_path, f)
-        for f in os.listdir(args.audio_path)
-        if f.endswith(".wav")
-    }
-    textgrid_files = {
-        os.path.splitext(f)[0]: os.path.join(args.textgrids_path, f)
-        for f in os.listdir(args.textgrids_path)
-        if f.endswith(".TextGrid")
-    }
+    audio_files = index_files(args.audio_path, ".wav")
+    textgrid_files = index_files(args.textgrids_path, ".TextGrid")
 
-    matched_files = set(audio_files.keys()) & set(textgrid_files.keys())
-
-    # Filters out files in the exclusion list
-    matched_files = {f for f in matched_files if f not in FILES_TO_EXCLUDE}
+    # Filters out files in the exclusion list and sorts the rest so files are dispatched in a fixed order
+    matched_files = sorted(
+        (set(audio_files) & set(textgrid_files)) - set(FILES_TO_EXCLUDE)
+    )
 
     if not matched_files:
         raise ValueError(
@@ -206,84 +539,75 @@ def main():
 
     print("Starting processing")
 
+    tasks = [
+        (
+            audio_files[file_name],
+            textgrid_files[file_name],
+            args.phones,
+            args.formants,
+            args.points,
+            args.following_phone,
+            args.maximum_formant,
+            cache_dir,
+        )
+        for file_name in matched_files
+    ]
+
+    # The columns only depend on the arguments, so no file has to be processed first
+    fieldnames = get_fieldnames(args.formants, args.following_phone)
+
     if args.separate_files:
-        all_data = []
-        for file_name in matched_files:
-            print(f"Processing {file_name}")
-            audio_file_path = audio_files[file_name]
-            textgrid_file_path = textgrid_files[file_name]
-            formant_data = extract_formants_from_file(
-                audio_file_path=audio_file_path,
-                textgrid_file_path=textgrid_file_path,
-                phones=args.phones,
-                desired_formants=args.formants,
-                points=args.points,
-                include_following=args.following_phone,
-            )
-            all_data.extend(formant_data)
-
-        if all_data:
-            # Groups data by speaker
-            speaker_data = {}
-            for row in all_data:
-                speaker = row["speaker"]
-                if speaker not in speaker_data:
-                    speaker_data[speaker] = []
-                speaker_data[speaker].append(row)
-
-            # Writes separate files for each speaker
-            fieldnames = list(all_data[0].keys())
-            for speaker, data in speaker_data.items():
-                output_file = os.path.join(
-                    args.output_folder, f"{speaker}_formants.csv"
-                )
-                with open(
-                    output_file, "w", newline="", encoding="utf-8"
-                ) as csvfile:
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(data)
-                print(f"Speaker {speaker} data saved to {output_file}")
+        # Speaker files are opened the first time a speaker shows up and written to as each file finishes
+        with ExitStack() as stack:
+            speaker_writers = {}
+            speaker_files = {}
+            for formant_data in process_files(tasks):
+                # Groups this file's rows by speaker
+                speaker_data = defaultdict(list)
+                for row in formant_data:
+                    speaker_data[row[1]].append(row)
+
+                for speaker, data in speaker_data.items():
+                    if speaker not in speaker_writers:
+                        output_file = os.path.join(
+                            args.output_folder, f"{speaker}_formants.csv"
+                        )
+                        csvfile = stack.enter_context(
+                            open(
+                                output_file,
+                                "w",
+                                newline="",
+                                encoding="utf-8",
+                                buffering=1 << 20,
+                            )
+                        )
+                        speaker_writers[speaker] = csv.writer(csvfile)
+                        speaker_writers[speaker].writerow(fieldnames)
+                        speaker_files[speaker] = output_file
+                    speaker_writers[speaker].writerows(data)
+
+        for speaker, output_file in speaker_files.items():
+            print(f"Speaker {speaker} data saved to {output_file}")
     else:
         # Opens the output file and write header
         output_file = os.path.join(args.output_folder, "formants.csv")
-        with open(output_file, "w", newline="", encoding="utf-8") as csvfile:
-            # We need to determine the fieldnames first by processing one file to see what formants are included
-            first_file = next(iter(matched_files))
-            first_audio_path = audio_files[first_file]
-            first_textgrid_path = textgrid_files[first_file]
-
-            print(f"Processing {first_file}")
-            first_data = extract_formants_from_file(
-                audio_file_path=first_audio_path,
-                textgrid_file_path=first_textgrid_path,
-                phones=args.phones,
-                desired_formants=args.formants,
-                points=args.points,
-                include_following=args.following_phone,
-            )
-
-            if first_data:
-                fieldnames = list(first_data[0].keys())
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(first_data)
-
-                # Processes remaining files
-                remaining_files = matched_files - {first_file}
-                for file_name in remaining_files:
-                    print(f"Processing {file_name}")
-                    audio_file_path = audio_files[file_name]
-                    textgrid_file_path = textgrid_files[file_name]
-                    formant_data = extract_formants_from_file(
-                        audio_file_path=audio_file_path,
-                        textgrid_file_path=textgrid_file_path,
-                        phones=args.phones,
-                        desired_formants=args.formants,
-                        points=args.points,
-                        include_following=args.following_phone,
-                    )
-                    writer.writerows(formant_data)
+        with open(
+            output_file,
+            "w",
+            newline="",
+            encoding="utf-8",
+            buffering=1 << 20,
+        ) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(fieldnames)
+
+            for formant_data in process_files(tasks):
+                writer.writerows(formant_data)
+
+    if cache_dir is not None:
+        prune_formant_cache(
+            cache_dir, max(MAX_FORMANT_CACHE_ENTRIES, len(tasks))
+        )
 
     print(f"Formant data saved to {args.output_folder}")
 
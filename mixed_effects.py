@@ -1,33 +1,123 @@
 import pandas as pd
-import statsmodels.formula.api as smf
+import statsmodels.api as sm
 import argparse
+import hashlib
+import os
+
+# Bumped whenever build_design_matrices changes its output, so old cache entries aren't reused
+CACHE_VERSION = "3"
+MAX_CACHE_ENTRIES = 20
+
+def build_design_matrices(csv_path, dependent_variable, independent_variables, categorical_variables, groups):
+    """
+    Args:
+        csv_path (str): Path to CSV file
+        dependent_variable (str): Dependent variable
+        independent_variables (list): Independent variables
+        categorical_variables (list): Variables to treat as categorical
+        groups (str): Variable for random intercepts
+
+    Returns:
+        tuple: (endog, exog, group_codes) ready to pass to MixedLM
+    """
+    # Only reads the columns the model uses. Types are left to pandas so numeric categorical
+    # levels are converted to categories below and sort by value, as they did with patsy
+    columns = list(dict.fromkeys([dependent_variable] + independent_variables + [groups]))
+    df = pd.read_csv(csv_path, usecols=columns)
+
+    # Drops incomplete rows up front instead of leaving it to statsmodels
+    df = df.dropna(subset=columns)
+
+    # Builds design matrix, dummy coding categorical variables against their first level.
+    # Like patsy, non-numeric and boolean columns are treated as categorical even if not listed,
+    # and dummy columns are named the way patsy names them
+    exog_terms = [pd.Series(1.0, index=df.index, name="Intercept")]
+    for var in independent_variables:
+        if var in categorical_variables:
+            term = f"C({var})"
+        elif not pd.api.types.is_numeric_dtype(df[var]) or pd.api.types.is_bool_dtype(df[var]):
+            term = var
+        else:
+            exog_terms.append(df[var].astype(float))
+            continue
+        dummies = pd.get_dummies(df[var].astype("category"), drop_first=True, dtype=float)
+        dummies.columns = [f"{term}[T.{level}]" for level in dummies.columns]
+        exog_terms.append(dummies)
+    exog = pd.concat(exog_terms, axis=1)
+
+    endog = df[dependent_variable].astype(float)
+    group_codes = df[groups].astype("category").cat.codes.to_numpy()
+
+    return endog, exog, group_codes
+
+def load_design_matrices(csv_path, dependent_variable, independent_variables, categorical_variables, groups, cache_dir=None):
+    """
+    Same as build_design_matrices, but when cache_dir is given the result is pickled there,
+    keyed by the CSV's path and modification time and the model variables, so reruns that only
+    change fitting options skip parsing the CSV and building the matrices. Only the
+    MAX_CACHE_ENTRIES most recently written entries are kept, and caching is skipped with a
+    warning if cache_dir can't be written to.
+    """
+    if cache_dir is None:
+        return build_design_matrices(csv_path, dependent_variable, independent_variables, categorical_variables, groups)
+
+    csv_path = os.path.abspath(csv_path)
+    key_source = "|".join([
+        CACHE_VERSION,
+        csv_path,
+        str(os.path.getmtime(csv_path)),
+        dependent_variable,
+        ",".join(independent_variables),
+        ",".join(var for var in categorical_variables if var in independent_variables),
+        groups,
+    ])
+    cache_file = os.path.join(cache_dir, f"{hashlib.sha1(key_source.encode()).hexdigest()}.pkl")
+
+    if os.path.exists(cache_file):
+        return pd.read_pickle(cache_file)
+
+    matrices = build_design_matrices(csv_path, dependent_variable, independent_variables, categorical_variables, groups)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # pd.read_pickle can't load a half-written file, so the pickle only gets its real name once complete
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        pd.to_pickle(matrices, temp_file)
+        os.replace(temp_file, cache_file)
+
+        # Removes the oldest entries beyond the limit
+        entries = sorted(
+            (entry for entry in os.scandir(cache_dir) if entry.name.endswith(".pkl")),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in entries[MAX_CACHE_ENTRIES:]:
+            os.remove(entry.path)
+    except OSError as e:
+        print(f"Not caching design matrices in {cache_dir}: {e}")
+
+    return matrices
 
 def main():
     parser = argparse.ArgumentParser(description="Run mixed effects models on CSV data")
-    
+
     parser.add_argument("--csv_path", type=str, required=True, help="Path to CSV file")
     parser.add_argument("--dependent_variable", type=str, required=True, help="Dependent variable")
     parser.add_argument("--independent_variables", type=str, nargs="+", required=True, help="Independent variables")
     parser.add_argument("--categorical_variables", type=str, nargs="*", default=[], help="Variables to treat as categorical")
     parser.add_argument("--groups", type=str, required=True, help="Variable for random intercepts")
+    parser.add_argument("--cache_dir", type=str, default=".mlm_cache", help="Folder for cached design matrices (default: .mlm_cache in the current directory)")
+    parser.add_argument("--no_cache", action="store_true", help="Build the design matrices from scratch without reading or writing the cache")
 
     args = parser.parse_args()
-    
-    df = pd.read_csv(args.csv_path)
-    
-    # Builds formula
-    var_terms = []
-    for var in args.independent_variables:
-        if var in args.categorical_variables:
-            var_terms.append(f"C({var})")
-        else:
-            var_terms.append(var)
-    
-    formula = f"{args.dependent_variable} ~ {' + '.join(var_terms)}"
-    
-    model = smf.mixedlm(formula, data=df, groups=args.groups)
+
+    endog, exog, groups = load_design_matrices(args.csv_path, args.dependent_variable, args.independent_variables, args.categorical_variables, args.groups, cache_dir=None if args.no_cache else args.cache_dir)
+
+    # A named random intercept column keeps the group variable's name in the summary
+    exog_re = pd.Series(1.0, index=endog.index, name=args.groups)
+    model = sm.MixedLM(endog, exog, groups=groups, exog_re=exog_re)
     model_fit = model.fit()
-    
+
     print(model_fit.summary())
 
 if __name__ == "__main__":